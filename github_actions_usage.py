@@ -1,43 +1,105 @@
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+import httpx
+import diskcache
+import orjson
 import yaml
-from tabulate import tabulate
 import os
 from dotenv import load_dotenv
 import argparse
-import math
+import asyncio
+import itertools
+import random
+import sqlite3
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import threading
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs, urlparse
 
 # Load .env if present
 load_dotenv()
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 HEADERS = {"Authorization": f"token {GITHUB_TOKEN}"}
 
-# Create a session with retry logic
-def create_session():
-    session = requests.Session()
-    retries = Retry(
-        total=5,
-        backoff_factor=1,
-        status_forcelist=[429, 500, 502, 503, 504],
-        allowed_methods=["GET"],
-        raise_on_status=False
+# Full 100-item pages are more likely to hit GitHub-side timeouts; 80 keeps
+# responses comfortably under the limit with barely more requests
+PAGE_SIZE = 80
+
+# Runner-OS labels we map to cost rates
+OS_LABELS = frozenset(("linux", "windows", "macos"))
+
+# Create an HTTP/2 client with connect retries. HTTP/2 multiplexes many
+# concurrent requests over one TLS connection, and a single async client on
+# one event loop replaces the per-thread sessions entirely.
+def create_client():
+    # http2 and limits must go on the transport: when transport= is passed,
+    # httpx ignores the client-level flags
+    return httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(
+            retries=5,
+            http2=True,
+            limits=httpx.Limits(max_connections=100),
+        ),
+        timeout=30,
     )
-    adapter = HTTPAdapter(max_retries=retries)
-    session.mount("http://", adapter)
-    session.mount("https://", adapter)
-    return session
 
-# Thread-local storage for sessions
-thread_local = threading.local()
+# Shared client, created in main() for the lifetime of the run
+client = None
+
+# On-disk cache for API responses. Completed runs and their jobs never
+# change, so they can be cached forever; listings that may still grow get a
+# short TTL. Delete the cache directory to invalidate.
+CACHE_DIR = os.path.expanduser("~/.cache/gha-usage")
+CACHE_TTL = 600  # seconds, for listings that can still change
+
+api_cache = diskcache.Cache(CACHE_DIR)
 
-def get_session():
-    if not hasattr(thread_local, "session"):
-        thread_local.session = create_session()
-    return thread_local.session
+# Per-run contributions live in SQLite next to the cache, so later runs only
+# fetch runs created after what's already stored
+DB_PATH = os.path.join(CACHE_DIR, "usage.db")
+
+def open_db():
+    conn = sqlite3.connect(DB_PATH)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS runs (
+            run_id INTEGER,
+            repo TEXT,
+            workflow TEXT,
+            runner_type TEXT,
+            os_key TEXT,
+            minutes INTEGER,
+            created_at TEXT,
+            PRIMARY KEY (run_id, runner_type, os_key)
+        )
+    """)
+    # Where to resume fetching per repo: never past the oldest run that was
+    # still executing at the last sync, or its minutes would be lost
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sync_state (
+            repo TEXT PRIMARY KEY,
+            cursor TEXT
+        )
+    """)
+    return conn
+
+# Pull the last page number out of GitHub's Link header; 1 when absent
+def last_page_from_link(headers):
+    link = headers.get("Link")
+    if not link:
+        return 1
+    for part in link.split(","):
+        if 'rel="last"' in part:
+            last_url = part[part.index("<") + 1:part.index(">")]
+            return int(parse_qs(urlparse(last_url).query).get("page", [1])[0])
+    return 1
+
+async def cached_get(url, ttl=CACHE_TTL, headers=None):
+    entry = api_cache.get(url)
+    # Entries are (body, last_page) tuples; anything else is a stale format
+    if isinstance(entry, tuple):
+        return entry
+    resp = await tracked_request(url, headers=headers)
+    entry = (orjson.loads(resp.content), last_page_from_link(resp.headers))
+    api_cache.set(url, entry, expire=ttl)
+    return entry
 
 # Load config
 def load_costs():
@@ -45,184 +107,338 @@ def load_costs():
         return yaml.safe_load(f)
 
 # Get all owned repos (not forks)
-def get_repos():
+async def get_repos():
     print("Fetching repositories...")
-    repos = []
-    page = 1
-    while True:
-        url = f"https://api.github.com/user/repos?per_page=100&page={page}&type=owner"
-        resp = tracked_request(url, headers=HEADERS)
-        data = resp.json()
-        if not data:
-            break
-        repos += [r for r in data if not r["fork"]]
-        page += 1
+    url = f"https://api.github.com/user/repos?per_page={PAGE_SIZE}&type=owner"
+    resp = await tracked_request(f"{url}&page=1", headers=HEADERS)
+    data = orjson.loads(resp.content)
+    # The Link header on page 1 names the last page, so the rest can be
+    # fetched concurrently with no terminating empty-page request
+    last_page = last_page_from_link(resp.headers)
+    if last_page > 1:
+        rest = await asyncio.gather(
+            *(tracked_request(f"{url}&page={p}", headers=HEADERS) for p in range(2, last_page + 1))
+        )
+        for r in rest:
+            data += orjson.loads(r.content)
+    repos = [r for r in data if not r["fork"]]
     print(f"Found {len(repos)} repositories.")
     return repos
 
 # Get workflow usage for a repo
-def get_usage(owner, repo):
-    url = f"https://api.github.com/repos/{owner}/{repo}/actions/runs?per_page=100"
-    runs = []
-    page = 1
-    while True:
-        resp = tracked_request(f"{url}&page={page}", headers=HEADERS)
-        data = resp.json()
-        if "workflow_runs" not in data or not data["workflow_runs"]:
-            break
-        runs += data["workflow_runs"]
-        page += 1
+async def get_usage(owner, repo, since):
+    # Filter server-side by creation date: runs older than --since are
+    # outside the billing window we report on. All statuses are returned so
+    # the caller can see in-progress runs and avoid skipping them later.
+    # exclude_pull_requests drops the (often large) pull_requests array from
+    # each run object; we never read it
+    url = (f"https://api.github.com/repos/{owner}/{repo}/actions/runs"
+           f"?per_page={PAGE_SIZE}&created=>={since}&exclude_pull_requests=true")
+    data, last_page = await cached_get(f"{url}&page=1", headers=HEADERS)
+    runs = data.get("workflow_runs", [])
+    if last_page > 1:
+        rest = await asyncio.gather(
+            *(cached_get(f"{url}&page={p}", headers=HEADERS) for p in range(2, last_page + 1))
+        )
+        for body, _ in rest:
+            runs += body.get("workflow_runs", [])
     return runs
 
 # Get jobs for a workflow run
-def get_jobs(owner, repo, run_id):
-    jobs = []
-    page = 1
-    while True:
-        url = f"https://api.github.com/repos/{owner}/{repo}/actions/runs/{run_id}/jobs?per_page=100&page={page}"
-        resp = tracked_request(url, headers=HEADERS)
-        data = resp.json()
-        if "jobs" not in data or not data["jobs"]:
-            break
-        jobs += data["jobs"]
-        page += 1
+async def get_jobs(owner, repo, run_id, run_status=None):
+    # Jobs of a completed run are immutable, so cache them permanently
+    ttl = None if run_status == "completed" else CACHE_TTL
+    url = f"https://api.github.com/repos/{owner}/{repo}/actions/runs/{run_id}/jobs?per_page={PAGE_SIZE}"
+    data, last_page = await cached_get(f"{url}&page=1", ttl=ttl, headers=HEADERS)
+    jobs = data.get("jobs", [])
+    if last_page > 1:
+        rest = await asyncio.gather(
+            *(cached_get(f"{url}&page={p}", ttl=ttl, headers=HEADERS) for p in range(2, last_page + 1))
+        )
+        for body, _ in rest:
+            jobs += body.get("jobs", [])
     return jobs
 
-# Get timing for a workflow run
-def get_run_minutes(run):
-    timing_url = run["url"] + "/timing"
-    timing = tracked_request(timing_url, headers=HEADERS).json()
-    ms = timing.get("run_duration_ms", 0)
-    return ms / 60000
-
-api_call_count = 0
-api_call_lock = threading.Lock()
-
-def tracked_request(url, **kwargs):
-    global api_call_count
-    with api_call_lock:
-        api_call_count += 1
-    
-    session = get_session()
+# Process-wide cache for timing lookups, keyed by run URL (an lru_cache
+# can't wrap a coroutine, so a plain dict does the job)
+run_timing_cache = {}
+
+# Get timing for a workflow run, in whole minutes rounded up
+async def get_run_minutes(run_url):
+    minutes = run_timing_cache.get(run_url)
+    if minutes is None:
+        resp = await tracked_request(run_url + "/timing", headers=HEADERS)
+        timing = orjson.loads(resp.content)
+        ms = timing.get("run_duration_ms", 0)
+        minutes = -(-ms // 60000)
+        run_timing_cache[run_url] = minutes
+    return minutes
+
+# next() on a count() is atomic, so no lock is needed on the request path
+api_call_counter = itertools.count()
+
+# Shared view of the rate-limit window, updated from every response. Instead
+# of bursting through the quota and then sleeping until reset, each request
+# waits its share of the time left in the window (plus jitter so tasks
+# don't wake in lockstep). Everything runs on one event loop, so plain
+# globals are safe here.
+rate_limit_remaining = None
+rate_limit_reset_at = 0
+
+def update_rate_limit(headers):
+    global rate_limit_remaining, rate_limit_reset_at
+    if "X-RateLimit-Remaining" in headers:
+        rate_limit_remaining = int(headers["X-RateLimit-Remaining"])
+        rate_limit_reset_at = int(headers.get("X-RateLimit-Reset", 0))
+
+def rate_limit_delay():
+    if rate_limit_remaining is None or rate_limit_remaining > 500:
+        # Plenty of quota left; don't slow the happy path
+        return 0
+    delay = max(0, (rate_limit_reset_at - time.time()) / max(rate_limit_remaining, 1))
+    return min(delay, 60) + random.uniform(0, 0.2)
+
+# Cap total in-flight requests to stay clear of GitHub's secondary rate
+# limit on concurrency
+request_slots = asyncio.Semaphore(100)
+
+# Stand-in for httpx.Response when a 304 lets us reuse a cached body
+class CachedResponse:
+    def __init__(self, content, headers):
+        self.status_code = 200
+        self.content = content
+        self.headers = headers
+
+async def tracked_request(url, headers=None):
+    next(api_call_counter)
+
     max_attempts = 3
-    
+
+    # Send the last seen ETag so unchanged pages come back as a bodyless 304,
+    # which doesn't count against the primary rate limit. Entries are
+    # (etag, body, link_header); older two-field entries are ignored.
+    headers = dict(headers or {})
+    cached = api_cache.get(("etag", url))
+    if cached is not None and len(cached) != 3:
+        cached = None
+    if cached is not None:
+        headers["If-None-Match"] = cached[0]
+
     for attempt in range(max_attempts):
         try:
-            resp = session.get(url, **kwargs)
+            delay = rate_limit_delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            async with request_slots:
+                resp = await client.get(url, headers=headers)
+            update_rate_limit(resp.headers)
             # Handle rate limiting
             if resp.status_code == 403 and 'X-RateLimit-Remaining' in resp.headers:
                 if int(resp.headers['X-RateLimit-Remaining']) == 0:
                     reset_time = int(resp.headers['X-RateLimit-Reset'])
                     sleep_time = max(reset_time - time.time(), 0) + 1
                     print(f"\nRate limit reached. Sleeping for {sleep_time:.0f} seconds...")
-                    time.sleep(sleep_time)
-                    resp = session.get(url, **kwargs)
+                    await asyncio.sleep(sleep_time)
+                    async with request_slots:
+                        resp = await client.get(url, headers=headers)
+                    update_rate_limit(resp.headers)
+            # Secondary rate limit: a 429, or a 403 with Retry-After while
+            # quota remains. Sleep as directed and retry.
+            if resp.status_code == 429 or (resp.status_code == 403 and "Retry-After" in resp.headers):
+                if attempt < max_attempts - 1:
+                    wait_time = int(resp.headers.get("Retry-After", 2 ** attempt))
+                    print(f"\nSecondary rate limit hit. Sleeping for {wait_time} seconds...")
+                    await asyncio.sleep(wait_time)
+                    continue
+            # Retry transient server errors ourselves now that the urllib3
+            # Retry adapter is gone
+            if resp.status_code in (500, 502, 503, 504) and attempt < max_attempts - 1:
+                await asyncio.sleep(2 ** attempt)
+                continue
+            if resp.status_code == 304 and cached is not None:
+                # A 304 has no guaranteed Link header, so replay the one
+                # stored with the ETag or pagination would truncate to page 1
+                replay_headers = dict(resp.headers)
+                if cached[2]:
+                    replay_headers["Link"] = cached[2]
+                return CachedResponse(cached[1], replay_headers)
+            # Anything else must not reach callers as data: an error body
+            # would be cached (or written to SQLite) as real page content
+            if resp.status_code != 200:
+                raise RuntimeError(f"GitHub API returned {resp.status_code} for {url}")
+            etag = resp.headers.get("ETag")
+            if etag:
+                api_cache.set(("etag", url), (etag, resp.content, resp.headers.get("Link")))
             return resp
-        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        except httpx.TransportError as e:
             if attempt < max_attempts - 1:
                 wait_time = 2 ** attempt  # Exponential backoff: 1s, 2s, 4s
                 print(f"\nNetwork error, retrying in {wait_time}s... (attempt {attempt + 1}/{max_attempts})")
-                time.sleep(wait_time)
+                await asyncio.sleep(wait_time)
             else:
                 raise  # Re-raise after final attempt
 
-# Process a single repository
-def process_repo(repo, args):
+# Print rows as a fixed-width table: one pass for column widths, one to print
+def print_table(rows, headers):
+    cells = [headers] + [[str(c) for c in row] for row in rows]
+    widths = [max(len(c) for c in col) for col in zip(*cells)]
+    print("  ".join(f"{h:<{w}}" for h, w in zip(headers, widths)))
+    print("  ".join("-" * w for w in widths))
+    for row in cells[1:]:
+        print("  ".join(f"{c:<{w}}" for c, w in zip(row, widths)))
+
+# Process a single repository: fetch runs newer than what the database
+# already holds and store their per-run contributions
+async def process_repo(repo, args, conn, cursor):
     owner = repo["owner"]["login"]
     name = repo["name"]
-    local_summary = {}
-    runs = get_usage(owner, name)
-    for run in runs:
-        run_id = run["id"]
+    # Resume from the stored cursor rather than the full --since window
+    since = args.since
+    if cursor and cursor[:10] > since:
+        since = cursor[:10]
+    seen = {row[0] for row in conn.execute("SELECT run_id FROM runs WHERE repo = ?", (name,))}
+    all_runs = await get_usage(owner, name, since)
+    # Only completed runs are billed; the in-progress ones bound how far the
+    # resume cursor may advance
+    active = [r.get("created_at", "") for r in all_runs if r.get("status") != "completed"]
+    runs = [r for r in all_runs if r.get("status") == "completed" and r["id"] not in seen]
+    # Fetch jobs for all new runs concurrently; the request semaphore bounds
+    # how many requests are actually in flight
+    job_lists = await asyncio.gather(
+        *(get_jobs(owner, name, run["id"], run.get("status")) for run in runs)
+    )
+    rows = []
+    for run, jobs in zip(runs, job_lists):
         workflow_name = run.get("name", "(unknown workflow)")
-        jobs = get_jobs(owner, name, run_id)
+        per_key = defaultdict(int)
         for job in jobs:
-            # Detect runner type and OS from job labels
-            labels = job.get("labels", [])
-            runner_type = "github_hosted"
-            os_key = "linux"
-            if any("self-hosted" in l for l in labels):
+            # Detect runner type and OS from job labels in a single pass
+            labels = frozenset(job.get("labels", []))
+            if "self-hosted" in labels:
                 runner_type = "self_hosted"
                 os_key = "all"
-            elif labels:
-                for l in labels:
-                    if l in ("linux", "windows", "macos"):
-                        os_key = l
+            else:
+                runner_type = "github_hosted"
+                os_key = next((l for l in labels if l in OS_LABELS), "linux")
             # Use job duration in minutes, always round up to next minute
             ms = job.get("run_duration_ms")
             if ms is None:
-                # fallback to run duration if job duration is missing
-                minutes = get_run_minutes(run)
+                # fallback to run duration if job duration is missing; the
+                # per-URL timing cache means several jobs in one run cost a
+                # single request, and in-progress runs are skipped since
+                # their timing is meaningless
+                if run.get("status") == "completed":
+                    minutes = await get_run_minutes(run["url"])
+                else:
+                    minutes = 0
             else:
-                minutes = ms / 60000
-            minutes = math.ceil(minutes)  # Always round up to next minute
-            if args.by_workflow:
-                key = (name, workflow_name, runner_type, os_key)
-            elif args.by_repo:
-                key = (name, runner_type, os_key)
-            else:
-                key = (runner_type, os_key)
-            local_summary.setdefault(key, 0)
-            local_summary[key] += minutes
-    return name, local_summary
+                # Ceil-division keeps this in integer math: round up to the
+                # next whole minute without a float divide or math.ceil
+                minutes = -(-ms // 60000)
+            per_key[(runner_type, os_key)] += minutes
+        for (runner_type, os_key), minutes in per_key.items():
+            rows.append((run["id"], name, workflow_name, runner_type, os_key,
+                         minutes, run.get("created_at", "")))
+    conn.executemany("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    # Advance the cursor only to the oldest run still executing; past that
+    # point the run would never be re-fetched once it completes
+    if active:
+        next_cursor = min(active)
+    elif all_runs:
+        next_cursor = max(r.get("created_at", "") for r in all_runs)
+    else:
+        next_cursor = cursor
+    if next_cursor:
+        conn.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?)", (name, next_cursor))
+    conn.commit()
+    return name, len(runs)
 
 # Main aggregation logic
-def main():
+async def main():
+    global client
     start_time = time.time()
     parser = argparse.ArgumentParser(description="GitHub Actions Usage Reporter")
     parser.add_argument("--by-repo", action="store_true", help="Break down usage by repository")
     parser.add_argument("--by-workflow", action="store_true", help="Break down usage by workflow within each repository")
-    parser.add_argument("--workers", type=int, default=10, help="Number of parallel workers (default: 10)")
+    parser.add_argument("--workers", type=int, default=10, help="Number of repositories processed concurrently (default: 10)")
+    default_since = (datetime.now(timezone.utc) - timedelta(days=30)).strftime("%Y-%m-%d")
+    parser.add_argument("--since", default=default_since,
+                        help="Only count runs created on or after this date, YYYY-MM-DD (default: 30 days ago)")
     args = parser.parse_args()
 
     if not GITHUB_TOKEN:
         print("Set GITHUB_TOKEN env variable.")
         return
     costs = load_costs()
-    repos = get_repos()
-    summary = {}
-    
-    print(f"Processing {len(repos)} repositories with {args.workers} parallel workers...")
-    completed = 0
-    
-    # Process repositories in parallel
-    with ThreadPoolExecutor(max_workers=args.workers) as executor:
-        future_to_repo = {executor.submit(process_repo, repo, args): repo for repo in repos}
-        for future in as_completed(future_to_repo):
-            repo = future_to_repo[future]
+    # Flatten to one lookup per row instead of two nested .get calls
+    cost_table = {(rt, ok): rate for rt, rates in costs.items() for ok, rate in rates.items()}
+    summary = Counter()
+    conn = open_db()
+    cursors = dict(conn.execute("SELECT repo, cursor FROM sync_state"))
+
+    async with create_client() as client:
+        repos = await get_repos()
+
+        print(f"Processing {len(repos)} repositories with up to {args.workers} in flight...")
+        completed = 0
+
+        # Bound how many repositories are processed at once; within each,
+        # per-run job fetches already fan out concurrently
+        repo_slots = asyncio.Semaphore(args.workers)
+
+        async def process_with_limit(repo):
+            async with repo_slots:
+                try:
+                    return await process_repo(repo, args, conn, cursors.get(repo["name"]))
+                except Exception as e:
+                    return repo["name"], e
+
+        for future in asyncio.as_completed([process_with_limit(r) for r in repos]):
+            repo_name, result = await future
             completed += 1
-            try:
-                repo_name, local_summary = future.result()
-                # Merge local summary into global summary
-                for key, minutes in local_summary.items():
-                    summary.setdefault(key, 0)
-                    summary[key] += minutes
-                print(f"[{completed}/{len(repos)}] Completed: {repo_name}")
-            except Exception as e:
-                print(f"[{completed}/{len(repos)}] Error processing {repo['name']}: {e}")
+            if isinstance(result, Exception):
+                print(f"[{completed}/{len(repos)}] Error processing {repo_name}: {result}")
+            else:
+                print(f"[{completed}/{len(repos)}] Completed: {repo_name} ({result} new runs)")
+
+    # Build the summary from everything stored in the window, not just what
+    # this invocation fetched
+    for name, workflow, runner_type, os_key, minutes in conn.execute(
+        "SELECT repo, workflow, runner_type, os_key, minutes FROM runs WHERE created_at >= ?",
+        (args.since,),
+    ):
+        if args.by_workflow:
+            key = (name, workflow, runner_type, os_key)
+        elif args.by_repo:
+            key = (name, runner_type, os_key)
+        else:
+            key = (runner_type, os_key)
+        summary[key] += minutes
+    conn.close()
     print("\nSummary of GitHub Actions usage:")
     print("Note: GitHub-hosted runner costs reflect actual pricing. Self-hosted runner costs are hypothetical (what you would pay if billed).\n")
     table = []
     if args.by_workflow:
         for (repo, workflow, runner_type, os_key), minutes in summary.items():
-            cost_per_min = costs.get(runner_type, {}).get(os_key, 0)
+            cost_per_min = cost_table.get((runner_type, os_key), 0)
             total_cost = minutes * cost_per_min
             table.append([repo, workflow, runner_type, os_key, round(minutes, 2), f"${total_cost:.2f}"])
-        print(tabulate(table, headers=["Repository", "Workflow", "Runner Type", "OS", "Minutes", "Cost"]))
+        print_table(table, ["Repository", "Workflow", "Runner Type", "OS", "Minutes", "Cost"])
     elif args.by_repo:
         for (repo, runner_type, os_key), minutes in summary.items():
-            cost_per_min = costs.get(runner_type, {}).get(os_key, 0)
+            cost_per_min = cost_table.get((runner_type, os_key), 0)
             total_cost = minutes * cost_per_min
             table.append([repo, runner_type, os_key, round(minutes, 2), f"${total_cost:.2f}"])
-        print(tabulate(table, headers=["Repository", "Runner Type", "OS", "Minutes", "Cost"]))
+        print_table(table, ["Repository", "Runner Type", "OS", "Minutes", "Cost"])
     else:
         for (runner_type, os_key), minutes in summary.items():
-            cost_per_min = costs.get(runner_type, {}).get(os_key, 0)
+            cost_per_min = cost_table.get((runner_type, os_key), 0)
             total_cost = minutes * cost_per_min
             table.append([runner_type, os_key, round(minutes, 2), f"${total_cost:.2f}"])
-        print(tabulate(table, headers=["Runner Type", "OS", "Minutes", "Cost"]))
+        print_table(table, ["Runner Type", "OS", "Minutes", "Cost"])
     elapsed = time.time() - start_time
-    print(f"\nRun completed in {elapsed:.1f} seconds. API calls made: {api_call_count}")
+    # The counter has yielded 0..N-1, so the next value is the call total
+    print(f"\nRun completed in {elapsed:.1f} seconds. API calls made: {next(api_call_counter)}")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())